@@ -3,7 +3,6 @@ See how well the Multihead model can predict the Beaufort scale from the image.
 """
 
 import argparse
-from typing import Callable
 from functools import partial
 import os
 import logging
@@ -12,25 +11,19 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
-from datasets import load_dataset
-from transformers import AutoImageProcessor, DefaultDataCollator
+from datasets import load_dataset, Image as ImageFeature
+from transformers import AutoImageProcessor
 
-from seesea.model.multihead.multihead_model import MultiHeadModel  # Import the model class
+from seesea.model.multihead.multihead_model import load_multihead_model
 from seesea.model.beaufort.beaufort_utils import mps_to_beaufort
+from seesea.model.utils.gpu_transforms import GPUImagePreprocessor, collate_jpeg, preprocess_batch_jpeg
 
 LOGGER = logging.getLogger(__name__)
 
 
-def preprocess_batch(transform: Callable, output_names: list, samples):
-    """Preprocess a batch of samples"""
-    samples["pixel_values"] = transform(samples["jpg"])["pixel_values"]
-    samples["labels"] = [[obj[key] for key in output_names] for obj in samples["json"]]
-    return samples
-
-
 def main(args):
     # Load the model
-    model = torch.load(os.path.join(args.model_dir, "model.pt"))
+    model = load_multihead_model(args.model_dir, allow_pickle=args.allow_pickle)
     image_processor = AutoImageProcessor.from_pretrained(os.path.join(args.model_dir))
 
     with open(os.path.join(args.model_dir, "output_names.txt"), "r", encoding="utf-8") as f:
@@ -41,13 +34,10 @@ def main(args):
 
     wind_speed_idx = output_names.index("wind_speed_mps")
     # Setup dataset
-    map_fn = partial(preprocess_batch, image_processor, output_names)
+    map_fn = partial(preprocess_batch_jpeg, output_names)
     dataset = load_dataset("webdataset", data_dir=args.dataset, split=args.split, streaming=True)
-    dataset = dataset.map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
-
-    # Setup dataloader
-    collator = DefaultDataCollator()
-    loader = DataLoader(dataset, collate_fn=collator, batch_size=args.batch_size)
+    dataset = dataset.cast_column("jpg", ImageFeature(decode=False))
+    dataset = dataset.map(map_fn, batched=True, remove_columns=dataset.column_names)
 
     # Get the device
     if torch.cuda.is_available():
@@ -59,6 +49,11 @@ def main(args):
 
     model = model.to(device)
     model.eval()
+    preprocessor = GPUImagePreprocessor(image_processor, device)
+
+    # Setup dataloader
+    collate_fn = partial(collate_jpeg, preprocessor=preprocessor)
+    loader = DataLoader(dataset, collate_fn=collate_fn, batch_size=args.batch_size)
 
     beaufort_predictions = []
     beaufort_labels = []
@@ -66,10 +61,10 @@ def main(args):
     for batch in tqdm(loader, desc="Testing", disable=LOGGER.level > logging.INFO):
 
         beaufort_labels += [mps_to_beaufort(obj[wind_speed_idx]) for obj in batch["labels"]]
-        batch = {k: v.to(device) for k, v in batch.items()}
+        pixel_values = preprocessor.prepare(batch)
 
         with torch.no_grad():
-            _, logits = model(**batch)
+            _, logits = model(pixel_values)
 
         # Get the predictions at the wind speed index
         predictions = logits.cpu().numpy()
@@ -91,6 +86,9 @@ def get_args_parser():
     parser.add_argument("--dataset", help="Path to the directory containing the dataset to load")
     parser.add_argument("--split", help="Which dataset split to load.", default="test")
     parser.add_argument("--model-dir", help="Path to the directory containing the trained model.")
+    parser.add_argument(
+        "--allow-pickle", action="store_true", help="Load a trusted pickled model.pt from an older training run"
+    )
     parser.add_argument("--batch-size", type=int, help="Batch size for testing", default=32)
     parser.add_argument("--log", type=str, help="Log level", default="INFO")
     parser.add_argument("--log-file", type=str, help="Log file", default=None)
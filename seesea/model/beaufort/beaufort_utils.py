@@ -1,6 +1,11 @@
 """Common functions for the Beaufort models"""
 
-from typing import Callable
+import os
+
+import torch
+from transformers import AutoConfig, AutoModelForImageClassification
+
+from seesea.model.utils.checkpoint import load_checkpoint
 
 
 BeaufortRanges = [
@@ -55,8 +60,19 @@ id2label_beaufort = {
 label2id_beaufort = {v: k for k, v in id2label_beaufort.items()}
 
 
-def preprocess_batch_beaufort(transform: Callable, samples):
-    """Preprocess a batch of samples"""
-    samples["pixel_values"] = transform(samples["jpg"])["pixel_values"]
-    samples["labels"] = [mps_to_beaufort(obj["wind_speed_mps"]) for obj in samples["json"]]
-    return samples
+def preprocess_batch_beaufort_jpeg(samples):
+    """Preprocess a batch of samples into raw JPEG bytes and Beaufort scale class labels"""
+    return {
+        "jpg": [jpg["bytes"] for jpg in samples["jpg"]],
+        "labels": [mps_to_beaufort(obj["wind_speed_mps"]) for obj in samples["json"]],
+    }
+
+
+def load_beaufort_model(model_dir: str, map_location="cpu", allow_pickle: bool = False):
+    """Rebuild a Beaufort classification model from the config and state dict checkpoint in a training output dir"""
+    checkpoint = load_checkpoint(os.path.join(model_dir, "model.pt"), map_location, allow_pickle)
+    if isinstance(checkpoint, torch.nn.Module):
+        return checkpoint
+    model = AutoModelForImageClassification.from_config(AutoConfig.from_pretrained(model_dir))
+    model.load_state_dict(checkpoint["state_dict"], assign=True)
+    return model
@@ -1,21 +1,27 @@
 """Test the Beaufort model"""
 
 import os
-from functools import partial
 import logging
+from functools import partial
 import datetime
 
-from datasets import load_dataset
-import evaluate
+from datasets import load_dataset, Image as ImageFeature
 import torch
-from transformers import AutoImageProcessor, DefaultDataCollator
+from transformers import AutoImageProcessor
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 import seaborn as sns
 import matplotlib.pyplot as plt
 
 
-from seesea.model.beaufort.beaufort_utils import preprocess_batch_beaufort
+from seesea.model.beaufort.beaufort_utils import (
+    id2label_beaufort,
+    load_beaufort_model,
+    preprocess_batch_beaufort_jpeg,
+)
+from seesea.model.utils.cuda_graph import CUDAGraphForward
+from seesea.model.utils.gpu_transforms import GPUImagePreprocessor, collate_jpeg
+from seesea.model.utils.precision import get_mixed_precision_dtype, quantize_int8
 
 LOGGER = logging.getLogger(__name__)
 
@@ -24,17 +30,13 @@ def main(args):
     """Run tests on the Beaufort model"""
 
     # Load model and processor
-    model = torch.load(os.path.join(args.model_dir, "model.pt"))
+    model = load_beaufort_model(args.model_dir, allow_pickle=args.allow_pickle)
     image_processor = AutoImageProcessor.from_pretrained(os.path.join(args.model_dir))
 
     # Setup dataset
-    map_fn = partial(preprocess_batch_beaufort, image_processor)
     dataset = load_dataset("webdataset", data_dir=args.dataset, split=args.split, streaming=True)
-    dataset = dataset.map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
-
-    # Setup dataloader
-    collator = DefaultDataCollator()
-    loader = DataLoader(dataset, collate_fn=collator, batch_size=args.batch_size)
+    dataset = dataset.cast_column("jpg", ImageFeature(decode=False))
+    dataset = dataset.map(preprocess_batch_beaufort_jpeg, batched=True, remove_columns=dataset.column_names)
 
     # Set device
     if torch.cuda.is_available():
@@ -44,29 +46,67 @@ def main(args):
     else:
         device = torch.device("cpu")
 
-    model = model.to(device)
+    channels_last = device.type == "cuda"
+    model = model.to(device, memory_format=torch.channels_last if channels_last else torch.preserve_format)
+    preprocessor = GPUImagePreprocessor(image_processor, device, channels_last=channels_last)
+
+    # Setup dataloader
+    loader = DataLoader(
+        dataset,
+        collate_fn=partial(collate_jpeg, preprocessor=preprocessor),
+        batch_size=args.batch_size,
+        pin_memory=True,
+        num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=4 if args.num_workers > 0 else None,
+    )
+
+    if args.quantize:
+        LOGGER.info("Quantizing the model linear layers to INT8")
+        model = quantize_int8(model, device)
+    amp_dtype = None if args.full_precision else get_mixed_precision_dtype(device)
 
     # Run test
     test_start_time = datetime.datetime.now(tz=datetime.timezone.utc)
 
-    accuracy = evaluate.load("accuracy")
-    confusion_matrix = evaluate.load("confusion_matrix")
+    # Accumulate the confusion matrix on CUDA devices so the loop never waits on a device to host copy.
+    # Accumulating int64 index_put_ is not supported on every backend, other devices accumulate on the CPU
+    num_classes = len(id2label_beaufort)
+    confusion_device = device if device.type == "cuda" else torch.device("cpu")
+    confusion = torch.zeros((num_classes, num_classes), dtype=torch.long, device=confusion_device)
+
+    use_cuda_graph = args.cuda_graph and device.type == "cuda"
+    if args.cuda_graph and not use_cuda_graph:
+        LOGGER.warning("CUDA graphs require a CUDA device, running the model eagerly on %s", device)
+    graph_forward = None
 
     model.eval()
-    for batch in tqdm(loader, desc="Testing", disable=LOGGER.level > logging.INFO):
-        batch = {k: v.to(device) for k, v in batch.items()}
-        with torch.no_grad():
-            outputs = model(**batch)
+    if args.compile:
+        # Inductor would capture its own CUDA graphs inside the outer graph capture, leave those to CUDAGraphForward
+        model = torch.compile(model, mode="max-autotune-no-cudagraphs" if use_cuda_graph else "max-autotune")
+
+    def forward(pixel_values):
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            return model(pixel_values=pixel_values).logits
+
+    with torch.inference_mode():
+        for batch in tqdm(loader, desc="Testing", disable=LOGGER.level > logging.INFO):
+            labels = batch["labels"].to(confusion_device, non_blocking=True)
+            pixel_values = preprocessor.prepare(batch)
+            if use_cuda_graph and graph_forward is None:
+                # Every full batch has the same shape after preprocessing, capture the forward once
+                graph_forward = CUDAGraphForward(forward, pixel_values)
 
-        logits = outputs.logits
-        predictions = torch.argmax(logits, dim=-1)
-        accuracy.add_batch(predictions=predictions, references=batch["labels"])
-        confusion_matrix.add_batch(predictions=predictions, references=batch["labels"])
+            logits = graph_forward(pixel_values) if graph_forward is not None else forward(pixel_values)
+            predictions = torch.argmax(logits, dim=-1).to(confusion_device)
+            confusion.index_put_((labels, predictions), torch.ones_like(labels), accumulate=True)
+
+    confusion = confusion.cpu().numpy()
 
     test_end_time = datetime.datetime.now(tz=datetime.timezone.utc)
     LOGGER.info("Test duration: %s", test_end_time - test_start_time)
 
-    accuracy_score = accuracy.compute()
+    accuracy_score = {"accuracy": float(confusion.trace() / confusion.sum())}
 
     # Create output directory if it doesn't exist
     os.makedirs(args.output, exist_ok=True)
@@ -78,7 +118,7 @@ def main(args):
         f.write(str(accuracy_score))
 
     # Get confusion matrix
-    cm = confusion_matrix.compute()
+    cm = {"confusion_matrix": confusion}
     LOGGER.info("Confusion matrix: %s", cm)
 
     # Create plot
@@ -88,8 +128,8 @@ def main(args):
         annot=True,  # Show numbers in cells
         fmt="d",  # Format as integers
         cmap="Blues",  # Color scheme
-        xticklabels=range(13),  # Assuming Beaufort scale 0-12
-        yticklabels=range(13),
+        xticklabels=range(num_classes),  # Beaufort scale 0-12
+        yticklabels=range(num_classes),
     )
 
     plt.title("Confusion Matrix")
@@ -106,10 +146,20 @@ def get_args_parser():
 
     parser = argparse.ArgumentParser(description="Test the SeeSea beaufort model")
     parser.add_argument("--model-dir", help="Directory containing the trained model", required=True)
+    parser.add_argument(
+        "--allow-pickle", action="store_true", help="Load a trusted pickled model.pt from an older training run"
+    )
     parser.add_argument("--dataset", help="Directory containing the test dataset", required=True)
     parser.add_argument("--output", help="Directory to save test results", required=True)
     parser.add_argument("--split", help="Dataset split to use", default="test")
     parser.add_argument("--batch-size", type=int, help="Batch size for testing", default=32)
+    parser.add_argument(
+        "--num-workers", type=int, help="Number of dataloader worker processes", default=min(8, os.cpu_count() or 1)
+    )
+    parser.add_argument("--full-precision", action="store_true", help="Disable bf16/fp16 mixed precision inference")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile")
+    parser.add_argument("--cuda-graph", action="store_true", help="Capture the model forward in a CUDA graph")
+    parser.add_argument("--quantize", action="store_true", help="Quantize the model linear layers to INT8")
     parser.add_argument("--log", type=str, help="Log level", default="INFO")
     return parser
 
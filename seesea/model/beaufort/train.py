@@ -4,43 +4,34 @@ import os
 import logging
 from functools import partial
 import datetime
-from typing import Callable
 import json
 import argparse
 
 import numpy as np
-from torchvision import transforms
-from datasets import load_dataset
+from datasets import load_dataset, Image as ImageFeature
 
 from transformers import (
     AutoImageProcessor,
     AutoModelForImageClassification,
     TrainingArguments,
-    Trainer,
-    DefaultDataCollator,
 )
 
-import evaluate
 import torch
 from seesea.model.beaufort.beaufort_utils import (
     id2label_beaufort,
     label2id_beaufort,
-    preprocess_batch_beaufort,
+    preprocess_batch_beaufort_jpeg,
 )
+from seesea.model.utils.gpu_trainer import GPUPreprocessingTrainer
+from seesea.model.utils.gpu_transforms import GPUImagePreprocessor, RandomRotationBatch, collate_jpeg
 
 LOGGER = logging.getLogger(__name__)
 
 
-def augment_batch(augmentation: Callable, samples):
-    """Preprocess a batch of samples"""
-    samples["jpg"] = [augmentation(jpg) for jpg in samples["jpg"]]
-    return samples
-
-
-def compute_metrics(metric, eval_pred):
+def compute_metrics(eval_pred):
     predictions, labels = eval_pred
     predictions = np.argmax(predictions, axis=1)
-    return metric.compute(predictions=predictions, references=labels)
+    return {"accuracy": float(np.mean(predictions == labels))}
 
 
 def main(args):
@@ -102,47 +93,53 @@ def main(args):
             logging_strategy="steps",
             logging_steps=50,
             max_steps=total_steps,
+            dataloader_num_workers=args.num_workers,
+            dataloader_persistent_workers=args.num_workers > 0,
+            remove_unused_columns=False,
         )
     else:
         image_processor = AutoImageProcessor.from_pretrained(output_dir)
         training_args = torch.load(os.path.join(args.checkpoint, "training_args.bin"))
         training_args.ignore_data_skip = True
+        training_args.remove_unused_columns = False
 
     augmentation = None
     if args.rotation is not None:
-        augmentation = transforms.RandomRotation(args.rotation, interpolation=transforms.InterpolationMode.BILINEAR)
+        augmentation = RandomRotationBatch(args.rotation)
         LOGGER.info("Using random rotation of %.2f degrees for data augmentation", args.rotation)
 
-    map_fn = partial(preprocess_batch_beaufort, image_processor)
+    # Decode and preprocess on the training device, the same path the Beaufort test uses
+    preprocessor = GPUImagePreprocessor(image_processor, training_args.device, augmentation)
 
     full_dataset = load_dataset("webdataset", data_dir=args.input, streaming=True)
+    full_dataset = full_dataset.cast_column("jpg", ImageFeature(decode=False))
 
     train_ds = full_dataset["train"].take(num_training_samples).shuffle()
 
-    if augmentation is not None:
-        train_ds = train_ds.map(partial(augment_batch, augmentation), batched=True)
-
-    train_ds = train_ds.map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
-
-    val_ds = full_dataset["validation"].map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
-
-    data_collator = DefaultDataCollator()
+    train_ds = train_ds.map(
+        preprocess_batch_beaufort_jpeg, batched=True, remove_columns=full_dataset["train"].column_names
+    )
 
-    accuracy = evaluate.load("accuracy")
+    val_ds = full_dataset["validation"].map(
+        preprocess_batch_beaufort_jpeg, batched=True, remove_columns=full_dataset["validation"].column_names
+    )
 
-    trainer = Trainer(
+    trainer = GPUPreprocessingTrainer(
         model=model,
         args=training_args,
-        data_collator=data_collator,
+        data_collator=partial(collate_jpeg, preprocessor=preprocessor),
         train_dataset=train_ds,
         eval_dataset=val_ds,
-        compute_metrics=partial(compute_metrics, accuracy),
+        compute_metrics=compute_metrics,
+        preprocessor=preprocessor,
     )
 
     trainer.train(resume_from_checkpoint=args.checkpoint)
 
     # run the test set
-    test_ds = full_dataset["test"].map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
+    test_ds = full_dataset["test"].map(
+        preprocess_batch_beaufort_jpeg, batched=True, remove_columns=full_dataset["test"].column_names
+    )
 
     test_result = trainer.predict(test_ds)
 
@@ -150,7 +147,11 @@ def main(args):
 
     # save the model
 
-    torch.save(model, os.path.join(output_dir, "model.pt"))
+    model.config.save_pretrained(output_dir)
+    torch.save(
+        {"state_dict": model.state_dict(), "base_model_name": model_name_or_path},
+        os.path.join(output_dir, "model.pt"),
+    )
     LOGGER.info("Model saved successfully to %s", output_dir)
 
 
@@ -185,6 +186,9 @@ def get_args_parser():
     parser.add_argument("--batch-size", type=int, help="The batch size to use for training", default=32)
     parser.add_argument("--learning-rate", type=float, help="The learning rate to use for training", default=0.001)
     parser.add_argument("--warmup-ratio", type=float, help="The ratio of steps to use for warmup", default=0.1)
+    parser.add_argument(
+        "--num-workers", type=int, help="Number of dataloader worker processes", default=min(8, os.cpu_count() or 1)
+    )
 
     return parser
 
@@ -2,16 +2,18 @@
 Visualize the outputs of the beaufort model
 """
 
-import os
+import io
 import logging
 import torch
 import matplotlib.pyplot as plt
 import numpy as np
+from PIL import Image
 
-from datasets import load_dataset
+from datasets import load_dataset, Image as ImageFeature
 from transformers import AutoImageProcessor
 
-from seesea.model.beaufort.beaufort_utils import mps_to_beaufort, BeaufortRanges, id2label_beaufort
+from seesea.model.beaufort.beaufort_utils import mps_to_beaufort, BeaufortRanges, id2label_beaufort, load_beaufort_model
+from seesea.model.utils.gpu_transforms import GPUImagePreprocessor
 
 LOGGER = logging.getLogger(__name__)
 
@@ -19,11 +21,12 @@ LOGGER = logging.getLogger(__name__)
 def main(args):
 
     # Load the model and the preprocessor
-    model = torch.load(os.path.join(args.model_dir, "model.pt"))
+    model = load_beaufort_model(args.model_dir, allow_pickle=args.allow_pickle)
     image_processor = AutoImageProcessor.from_pretrained(args.model_dir)
 
     # Load the dataset
     dataset = load_dataset("webdataset", data_dir=args.dataset, split=args.split, streaming=True).shuffle()
+    dataset = dataset.cast_column("jpg", ImageFeature(decode=False))
 
     if torch.cuda.is_available():
         device = torch.device("cuda")
@@ -34,15 +37,16 @@ def main(args):
 
     model = model.to(device)
     model.eval()
+    preprocessor = GPUImagePreprocessor(image_processor, device)
 
     for sample in dataset:
-        image = sample["jpg"]
+        jpg = sample["jpg"]["bytes"]
+        image = Image.open(io.BytesIO(jpg))
         wind_speed = sample["json"]["wind_speed_mps"]
         image_name = sample["__key__"]
         beaufort = mps_to_beaufort(wind_speed)
 
-        transformed_image = image_processor(image, return_tensors="pt")
-        transformed_image = transformed_image["pixel_values"].to(device)
+        transformed_image = preprocessor([jpg])
 
         with torch.no_grad():
             outputs = model(transformed_image)
@@ -82,6 +86,9 @@ def get_args_parser():
     parser.add_argument("--dataset", help="Path to the directory containing the dataset to load")
     parser.add_argument("--split", help="Which dataset split to load.", default="test")
     parser.add_argument("--model-dir", help="Path to the directory containing the trained model.")
+    parser.add_argument(
+        "--allow-pickle", action="store_true", help="Load a trusted pickled model.pt from an older training run"
+    )
     parser.add_argument("--log", type=str, help="Log level", default="INFO")
     parser.add_argument("--log-file", type=str, help="Log file", default=None)
     parser.add_argument("--num-samples", type=int, help="Number of samples to run inference on", default=None)
@@ -20,7 +20,6 @@ from transformers import (
     DefaultDataCollator,
 )
 
-import evaluate
 import torch
 from torch.optim.lr_scheduler import StepLR
 
@@ -53,11 +52,11 @@ def augment_batch(augmentation: Callable, samples):
     return samples
 
 
-def compute_metrics(metric, eval_pred):
+def compute_metrics(eval_pred):
     """Compute metrics for the model"""
     predictions, labels = eval_pred
     predictions = np.argmax(predictions, axis=1)
-    return metric.compute(predictions=predictions, references=labels)
+    return {"accuracy": float(np.mean(predictions == labels))}
 
 
 def main(args):
@@ -143,8 +142,6 @@ def main(args):
 
     data_collator = DefaultDataCollator()
 
-    accuracy = evaluate.load("accuracy")
-
     # optimizer = AdamW(model.parameters(), lr=args.learning_rate)
     # lr_scheduler = StepLR(optimizer, step_size=6000, gamma=0.3, verbose=True)
 
@@ -154,7 +151,7 @@ def main(args):
         data_collator=data_collator,
         train_dataset=train_ds,
         eval_dataset=val_ds,
-        compute_metrics=partial(compute_metrics, accuracy),
+        compute_metrics=compute_metrics,
     )
 
     trainer.train(resume_from_checkpoint=args.checkpoint)
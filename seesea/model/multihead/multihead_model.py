@@ -1,5 +1,10 @@
+import os
+
 import torch
 from torch import nn
+from transformers import AutoConfig, AutoModelForImageClassification
+
+from seesea.model.utils.checkpoint import load_checkpoint
 
 
 class MultiHeadModel(nn.Module):
@@ -36,19 +41,26 @@ class MultiHeadModel(nn.Module):
         else:
             raise ValueError("Model must have either 'fc' or 'classifier' as final layer")
 
-        self.heads = nn.ModuleList([nn.Linear(hidden_size, 1) for _ in range(num_outputs)])
+        # One fused projection with an output per head, equivalent to a separate single output head per output
+        self.head = nn.Linear(hidden_size, num_outputs)
 
-    def forward(self, pixel_values, labels):
-        if labels is None:
-            raise ValueError("labels cannot be None")
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the heads were fused hold a separate single output layer per head
+        num_outputs = self.head.out_features
+        if f"{prefix}heads.0.weight" in state_dict:
+            for name in ("weight", "bias"):
+                state_dict[f"{prefix}head.{name}"] = torch.cat(
+                    [state_dict.pop(f"{prefix}heads.{i}.{name}") for i in range(num_outputs)]
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    def forward(self, pixel_values, labels=None):
         features = self.base_model.base_model(pixel_values)[0]  # Shape: [batch_size, channels, height, width]
 
         if self.pool is not None:
             # Apply pooling and reshape
             features = self.pool(features)  # Shape: [batch_size, channels, 1, 1]
             features = features.flatten(1)  # Shape: [batch_size, channels]
-            logits = torch.cat([head(features) for head in self.heads], dim=1)
 
         else:
             # Swin transformer
@@ -56,9 +68,33 @@ class MultiHeadModel(nn.Module):
             # Global Average Pooling: [batch_size, hidden_size]
             features = features.mean(dim=1)
 
-        logits = torch.cat([head(features) for head in self.heads], dim=1)
+        logits = self.head(features)  # Shape: [batch_size, num_outputs]
+
+        # Inference without labels skips the loss, the labels can then stay on the host
+        if labels is None:
+            return None, logits
 
         loss_fct = nn.MSELoss()
         loss = loss_fct(logits, labels.float())
 
         return loss, logits
+
+
+def load_multihead_model(model_dir: str, map_location="cpu", allow_pickle: bool = False) -> MultiHeadModel:
+    """Rebuild a MultiHeadModel from the base model config and state dict checkpoint in a training output dir"""
+    checkpoint = load_checkpoint(os.path.join(model_dir, "model.pt"), map_location, allow_pickle)
+    if isinstance(checkpoint, nn.Module):
+        # Old training runs pickled the whole model and did not save the base model config
+        if not hasattr(checkpoint, "heads"):
+            return checkpoint
+        # Pickled before the heads were fused, swap in the fused head and migrate the head weights into it
+        state_dict = checkpoint.state_dict()
+        heads = checkpoint.heads
+        del checkpoint.heads
+        checkpoint.head = nn.Linear(heads[0].in_features, len(heads))
+        checkpoint.load_state_dict(state_dict)
+        return checkpoint
+    base_model = AutoModelForImageClassification.from_config(AutoConfig.from_pretrained(model_dir))
+    model = MultiHeadModel(base_model, checkpoint["num_outputs"])
+    model.load_state_dict(checkpoint["state_dict"], assign=True)
+    return model
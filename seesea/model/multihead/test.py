@@ -3,21 +3,21 @@ Test the multihead model
 """
 
 import os
-from typing import Callable
 from functools import partial
 import logging
 import datetime
 import json
 
-from datasets import load_dataset
+from datasets import load_dataset, Image as ImageFeature
 import torch
 from torch.utils.data import DataLoader
-from transformers import AutoImageProcessor, DefaultDataCollator
+from transformers import AutoImageProcessor
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
-from seesea.model.multihead.multihead_model import MultiHeadModel  # Import the model class
+from seesea.model.multihead.multihead_model import load_multihead_model
+from seesea.model.utils.gpu_transforms import GPUImagePreprocessor, collate_jpeg, preprocess_batch_jpeg
 
 import warnings
 
@@ -26,13 +26,6 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 LOGGER = logging.getLogger(__name__)
 
 
-def preprocess_batch(transform: Callable, output_names: list, samples):
-    """Preprocess a batch of samples"""
-    samples["pixel_values"] = transform(samples["jpg"])["pixel_values"]
-    samples["labels"] = [[obj[key] for key in output_names] for obj in samples["json"]]
-    return samples
-
-
 def save_results(labels, predictions, output_dir):
     """Save test results and plots"""
     if not os.path.exists(output_dir):
@@ -103,7 +96,7 @@ def main(args):
     """Run test on multihead model"""
 
     # Load model and processor
-    model = torch.load(os.path.join(args.model_dir, "model.pt"))
+    model = load_multihead_model(args.model_dir, allow_pickle=args.allow_pickle)
     image_processor = AutoImageProcessor.from_pretrained(os.path.join(args.model_dir))
 
     # Get output names
@@ -113,13 +106,10 @@ def main(args):
     LOGGER.info("Testing model for outputs: %s", output_names)
 
     # Setup dataset
-    map_fn = partial(preprocess_batch, image_processor, output_names)
+    map_fn = partial(preprocess_batch_jpeg, output_names)
     dataset = load_dataset("webdataset", data_dir=args.dataset, split=args.split, streaming=True)
-    dataset = dataset.map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
-
-    # Setup dataloader
-    collator = DefaultDataCollator()
-    loader = DataLoader(dataset, collate_fn=collator, batch_size=args.batch_size)
+    dataset = dataset.cast_column("jpg", ImageFeature(decode=False))
+    dataset = dataset.map(map_fn, batched=True, remove_columns=dataset.column_names)
 
     # Set device
     if torch.cuda.is_available():
@@ -130,6 +120,17 @@ def main(args):
         device = torch.device("cpu")
 
     model = model.to(device)
+    preprocessor = GPUImagePreprocessor(image_processor, device)
+
+    # Setup dataloader
+    loader = DataLoader(
+        dataset,
+        collate_fn=partial(collate_jpeg, preprocessor=preprocessor),
+        batch_size=args.batch_size,
+        pin_memory=True,
+        num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+    )
 
     # Run test
     all_outputs = {name: [] for name in output_names}
@@ -144,9 +145,10 @@ def main(args):
         for i, name in enumerate(output_names):
             all_inputs[name].append(batch_labels[:, i])
 
-        batch = {k: v.to(device) for k, v in batch.items()}
+        # The labels are only compared on the host, only the images are needed on the device
+        pixel_values = preprocessor.prepare(batch)
         with torch.no_grad():
-            _, logits = model(**batch)
+            _, logits = model(pixel_values)
 
         # Split predictions into separate arrays for each output
         predictions = logits.cpu().numpy()
@@ -169,10 +171,16 @@ def get_args_parser():
 
     parser = argparse.ArgumentParser(description="Test the SeeSea multihead model")
     parser.add_argument("--model-dir", help="Directory containing the trained model", required=True)
+    parser.add_argument(
+        "--allow-pickle", action="store_true", help="Load a trusted pickled model.pt from an older training run"
+    )
     parser.add_argument("--dataset", help="Directory containing the test dataset", required=True)
     parser.add_argument("--output", help="Directory to save test results", required=True)
     parser.add_argument("--split", help="Dataset split to use", default="test")
     parser.add_argument("--batch-size", type=int, help="Batch size for testing", default=32)
+    parser.add_argument(
+        "--num-workers", type=int, help="Number of dataloader worker processes", default=min(8, os.cpu_count() or 1)
+    )
     parser.add_argument("--log", type=str, help="Log level", default="INFO")
     return parser
 
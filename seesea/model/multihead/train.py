@@ -4,50 +4,90 @@ import os
 import logging
 from functools import partial
 import datetime
-from typing import Callable
 import json
 import argparse
+import hashlib
+import glob
 
-from torchvision import transforms
-from datasets import load_dataset
+import numpy as np
+import webdataset as wds
+from datasets import load_dataset, Image as ImageFeature
 from transformers import (
+    AutoConfig,
     AutoImageProcessor,
     AutoModelForImageClassification,
     TrainingArguments,
-    Trainer,
-    DefaultDataCollator,
 )
-import evaluate
 import torch
+from torch.utils.data import DataLoader
 
 from seesea.model.multihead.multihead_model import MultiHeadModel
+from seesea.model.utils.gpu_trainer import GPUPreprocessingTrainer
+from seesea.model.utils.gpu_transforms import (
+    CachedImageDataset,
+    GPUImagePreprocessor,
+    RandomRotationBatch,
+    build_preprocessed_cache,
+    collate_jpeg,
+    get_resize_and_crop,
+    preprocess_batch_jpeg,
+    random_rot90_batch,
+)
+from seesea.model.utils.precision import get_mixed_precision_dtype, supports_tf32
 
 LOGGER = logging.getLogger(__name__)
 
 
-def augment_batch(augmentation: Callable, samples):
-    """Preprocess a batch of samples"""
-    samples["jpg"] = [augmentation(jpg) for jpg in samples["jpg"]]
-    return samples
-
-
-def preprocess_batch(transform: Callable, label_keys: list, samples):
-    """Preprocess a batch of samples"""
-    samples["pixel_values"] = transform(samples["jpg"])["pixel_values"]
-    samples["labels"] = [[obj[key] for key in label_keys] for obj in samples["json"]]
-    return samples
+def to_training_sample(label_keys: list, sample):
+    """Convert a (jpg bytes, observation) pair from the webdataset pipeline into a training sample"""
+    jpg, observation = sample
+    return {"jpg": jpg, "labels": np.array([observation[key] for key in label_keys], dtype=np.float32)}
+
+
+def get_training_shards(input_dir: str) -> list:
+    """Get the sorted list of training shard paths in a dataset directory"""
+    urls = sorted(glob.glob(os.path.join(input_dir, "train", "*.tar")))
+    if len(urls) == 0:
+        raise ValueError(f"No training shards found in {os.path.join(input_dir, 'train')}")
+    return urls
+
+
+def get_cache_key(image_processor, shards: list) -> str:
+    """Hash the image processor config and the training shards a preprocessed cache is built from"""
+    key = hashlib.sha1(image_processor.to_json_string().encode("utf-8"))
+    for shard in shards:
+        stat = os.stat(shard)
+        key.update(f"{os.path.abspath(shard)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return key.hexdigest()[:12]
+
+
+def make_training_pipeline(input_dir: str, label_keys: list, num_samples: int, shuffle_buffer: int = 1000):
+    """
+    Stream the training shards with webdataset, shuffling the shard order and a buffer of samples
+
+    The images are left as JPEG bytes, only the json observations are decoded. Shards are split between the nodes
+    of a distributed run and then between the dataloader workers by webdataset. A worker left without a shard, when
+    there are fewer shards than workers, yields no samples instead of raising.
+    """
+    urls = get_training_shards(input_dir)
+    return (
+        wds.WebDataset(urls, shardshuffle=len(urls), nodesplitter=wds.split_by_node, empty_check=False)
+        .shuffle(shuffle_buffer)
+        .decode()
+        .to_tuple("jpg", "json")
+        .map(partial(to_training_sample, label_keys))
+        .with_length(num_samples)
+    )
 
 
-def compute_metrics(metric, output_names, eval_pred):
+def compute_metrics(output_names, eval_pred):
     """Compute the metrics for the evaluation"""
     logits, labels = eval_pred
-    predictions = logits
-    results = {}
+    errors = np.abs(logits - labels)
     # Individual MAEs for each output
-    for i, name in enumerate(output_names):
-        results[f"mae_{name}"] = metric.compute(predictions=predictions[:, i], references=labels[:, i])["mae"]
+    results = {f"mae_{name}": float(errors[:, i].mean()) for i, name in enumerate(output_names)}
     # Overall MAE across all outputs
-    results["mae"] = metric.compute(predictions=predictions.flatten(), references=labels.flatten())["mae"]
+    results["mae"] = float(errors.mean())
     return results
 
 
@@ -56,6 +96,9 @@ def main(args):
 
     LOGGER.info("Training the model to classify %s", args.output_names)
 
+    if args.rotation_mode == "rot90" and args.rotation is not None:
+        raise ValueError("--rotation sets the angle for --rotation-mode free and cannot be used with rot90")
+
     os.makedirs(args.output, exist_ok=True)
 
     training_start_time = datetime.datetime.now(tz=datetime.timezone.utc)
@@ -82,7 +125,8 @@ def main(args):
         num_training_samples = 65536
         LOGGER.info("No split sizes found, using %d training samples", num_training_samples)
 
-    steps_per_epoch = num_training_samples // args.batch_size
+    # Each optimizer step consumes gradient_accumulation_steps batches
+    steps_per_epoch = num_training_samples // (args.batch_size * args.gradient_accumulation_steps)
     total_steps = steps_per_epoch * args.epochs
 
     if args.checkpoint is None:
@@ -91,8 +135,17 @@ def main(args):
         image_processor.save_pretrained(output_dir)
 
         base_model = AutoModelForImageClassification.from_pretrained(args.model, ignore_mismatched_sizes=True)
+        # Save the base model config so the architecture can be rebuilt to load the state dict
+        base_model.config.save_pretrained(output_dir)
+        base_model_name = args.model
+        if args.gradient_checkpointing:
+            base_model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
         model = MultiHeadModel(base_model, len(args.output_names))
 
+        # Weights stay in FP32, autocast runs the matmuls in reduced precision
+        train_device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+        amp_dtype = None if args.full_precision else get_mixed_precision_dtype(train_device)
+
         training_args = TrainingArguments(
             output_dir=output_dir,
             eval_strategy="epoch",
@@ -104,51 +157,104 @@ def main(args):
             warmup_ratio=args.warmup_ratio,
             per_device_train_batch_size=args.batch_size,
             per_device_eval_batch_size=args.batch_size,
+            gradient_accumulation_steps=args.gradient_accumulation_steps,
             logging_strategy="steps",
             logging_steps=50,
             max_steps=total_steps,
+            bf16=amp_dtype == torch.bfloat16,
+            fp16=amp_dtype == torch.float16,
+            tf32=True if supports_tf32(train_device) else None,
+            torch_compile=args.compile,
+            torch_compile_mode="reduce-overhead" if args.compile else None,
+            dataloader_pin_memory=True,
+            dataloader_drop_last=True,
+            dataloader_num_workers=args.num_workers,
+            dataloader_persistent_workers=args.num_workers > 0,
+            # The raw JPEG column is not a model input, it is consumed by the trainer preprocessing
+            remove_unused_columns=False,
         )
     else:
         image_processor = AutoImageProcessor.from_pretrained(output_dir)
-        model = torch.load(os.path.join(args.checkpoint))
+        base_config = AutoConfig.from_pretrained(output_dir)
+        base_model_name = base_config.name_or_path
+        base_model = AutoModelForImageClassification.from_config(base_config)
+        if args.gradient_checkpointing:
+            base_model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        # The weights are restored from the checkpoint by the trainer
+        model = MultiHeadModel(base_model, len(args.output_names))
         training_args = torch.load(os.path.join(args.checkpoint, "training_args.bin"))
         training_args.ignore_data_skip = True
+        training_args.remove_unused_columns = False
 
     augmentation = None
-    if args.rotation is not None:
-        augmentation = transforms.RandomRotation(args.rotation, interpolation=transforms.InterpolationMode.BILINEAR)
+    if args.rotation_mode == "rot90":
+        # Check the processor output size here rather than failing on the first training step
+        resize, crop = get_resize_and_crop(image_processor)
+        image_size = crop if crop is not None else resize
+        if isinstance(image_size, int) or image_size[0] != image_size[1]:
+            raise ValueError(f"--rotation-mode rot90 requires a square image size, the processor uses {image_size}")
+        augmentation = random_rot90_batch
+        LOGGER.info("Using random 90 degree rotations for data augmentation")
+    elif args.rotation is not None:
+        augmentation = RandomRotationBatch(args.rotation)
         LOGGER.info("Using random rotation of %.2f degrees for data augmentation", args.rotation)
 
-    map_fn = partial(preprocess_batch, image_processor, args.output_names)
+    # cuDNN picks faster convolution kernels for NHWC tensors on the GPU
+    channels_last = training_args.device.type == "cuda"
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
 
-    full_dataset = load_dataset("webdataset", data_dir=args.input, streaming=True)
-
-    train_ds = full_dataset["train"].take(num_training_samples).shuffle()
-
-    if augmentation is not None:
-        train_ds = train_ds.map(partial(augment_batch, augmentation), batched=True)
+    preprocessor = GPUImagePreprocessor(image_processor, training_args.device, augmentation, channels_last)
+    collate_fn = partial(collate_jpeg, preprocessor=preprocessor)
 
-    train_ds = train_ds.map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
+    map_fn = partial(preprocess_batch_jpeg, args.output_names)
 
-    val_ds = full_dataset["validation"].map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
+    full_dataset = load_dataset("webdataset", data_dir=args.input, streaming=True)
+    # Keep the images encoded, they are decoded in batches on the training device
+    full_dataset = full_dataset.cast_column("jpg", ImageFeature(decode=False))
 
-    data_collator = DefaultDataCollator()
+    train_ds = make_training_pipeline(args.input, args.output_names, num_training_samples, args.shuffle_buffer)
 
-    mae_metric = evaluate.load("mae")
+    if args.preprocessed_cache is not None:
+        # The cache depends on the image size and the input dataset, key it by the processor config and shards
+        shards = get_training_shards(args.input)
+        cache_key = get_cache_key(image_processor, shards)
+        cache_path = os.path.join(
+            args.preprocessed_cache, f"train_{num_training_samples}_{'_'.join(args.output_names)}_{cache_key}"
+        )
+        if not os.path.exists(cache_path):
+            LOGGER.info("Building the preprocessed training cache %s", cache_path)
+            os.makedirs(args.preprocessed_cache, exist_ok=True)
+            cache_loader = DataLoader(
+                train_ds,
+                collate_fn=collate_fn,
+                batch_size=args.batch_size,
+                # Workers beyond the shard count would have nothing to read
+                num_workers=min(args.num_workers, len(shards)),
+            )
+            build_preprocessed_cache(cache_loader, preprocessor, num_training_samples, cache_path)
+        LOGGER.info("Loading the preprocessed training cache %s", cache_path)
+        train_ds = CachedImageDataset(cache_path)
+
+    # Drop the raw columns inside the map, only the returned jpg bytes and labels are kept
+    val_ds = full_dataset["validation"].map(
+        map_fn, batched=True, remove_columns=full_dataset["validation"].column_names
+    )
 
-    trainer = Trainer(
+    trainer = GPUPreprocessingTrainer(
         model=model,
         args=training_args,
-        data_collator=data_collator,
+        data_collator=collate_fn,
         train_dataset=train_ds,
         eval_dataset=val_ds,
-        compute_metrics=partial(compute_metrics, mae_metric, args.output_names),
+        compute_metrics=partial(compute_metrics, args.output_names),
+        preprocessor=preprocessor,
     )
 
     trainer.train(resume_from_checkpoint=args.checkpoint)
 
     # run the test set
-    test_ds = full_dataset["test"].map(map_fn, batched=True).select_columns(["labels", "pixel_values"])
+    test_ds = full_dataset["test"].map(map_fn, batched=True, remove_columns=full_dataset["test"].column_names)
 
     test_result = trainer.predict(test_ds)
 
@@ -156,7 +262,14 @@ def main(args):
 
     # save the model
 
-    torch.save(model, os.path.join(output_dir, "model.pt"))
+    torch.save(
+        {
+            "state_dict": model.state_dict(),
+            "num_outputs": len(args.output_names),
+            "base_model_name": base_model_name,
+        },
+        os.path.join(output_dir, "model.pt"),
+    )
     LOGGER.info("Model saved successfully to %s", output_dir)
 
     # save the output name
@@ -174,6 +287,12 @@ def get_args_parser():
     parser.add_argument(
         "--rotation", type=float, help="The random rotation angle to use for data augmentation", default=None
     )
+    parser.add_argument(
+        "--rotation-mode",
+        choices=["free", "rot90"],
+        help="Rotate by a random angle up to --rotation (free) or by random multiples of 90 degrees (rot90)",
+        default="free",
+    )
 
     parser.add_argument("--log", type=str, help="Log level", default="INFO")
     parser.add_argument("--log-file", type=str, help="Log file", default=None)
@@ -194,6 +313,30 @@ def get_args_parser():
     parser.add_argument("--batch-size", type=int, help="The batch size to use for training", default=32)
     parser.add_argument("--learning-rate", type=float, help="The learning rate to use for training", default=0.001)
     parser.add_argument("--warmup-ratio", type=float, help="The ratio of steps to use for warmup", default=0.1)
+    parser.add_argument(
+        "--gradient-accumulation-steps",
+        type=int,
+        help="The number of batches to accumulate gradients over per optimizer step",
+        default=1,
+    )
+    parser.add_argument(
+        "--gradient-checkpointing",
+        action="store_true",
+        help="Recompute the backbone activations in the backward pass to fit larger batches",
+    )
+    parser.add_argument(
+        "--num-workers", type=int, help="Number of dataloader worker processes", default=min(8, os.cpu_count() or 1)
+    )
+    parser.add_argument("--full-precision", action="store_true", help="Disable bf16/fp16 mixed precision training")
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile")
+    parser.add_argument(
+        "--shuffle-buffer", type=int, help="The number of training samples to shuffle in memory", default=1000
+    )
+    parser.add_argument(
+        "--preprocessed-cache",
+        help="Directory to cache the decoded and resized training images in, built on the first run",
+        default=None,
+    )
     parser.add_argument(
         "--output-names",
         type=str,
@@ -3,24 +3,27 @@ Visualize the outputs of the multihead model
 """
 
 import argparse
+import io
 import os
 import logging
 
-from datasets import load_dataset
+from datasets import load_dataset, Image as ImageFeature
 import torch
 from transformers import AutoImageProcessor
 import matplotlib.pyplot as plt
+from PIL import Image
 
 from seesea.common import utils
 
-from seesea.model.multihead.multihead_model import MultiHeadModel  # Import the model class
+from seesea.model.multihead.multihead_model import load_multihead_model
+from seesea.model.utils.gpu_transforms import GPUImagePreprocessor
 
 LOGGER = logging.getLogger(__name__)
 
 
 def main(args):
     # Load model and processor
-    model = torch.load(os.path.join(args.model_dir, "model.pt"))
+    model = load_multihead_model(args.model_dir, allow_pickle=args.allow_pickle)
     image_processor = AutoImageProcessor.from_pretrained(os.path.join(args.model_dir))
 
     # Get output names
@@ -28,6 +31,8 @@ def main(args):
         output_names = f.read().strip().split("\n")
 
     dataset = load_dataset("webdataset", data_dir=args.dataset, split=args.split, streaming=True).shuffle()
+    # Keep the JPEG bytes for the preprocessor, the PIL image is only opened for display
+    dataset = dataset.cast_column("jpg", ImageFeature(decode=False))
 
     if torch.cuda.is_available():
         device = torch.device("cuda")
@@ -38,19 +43,20 @@ def main(args):
 
     model = model.to(device)
     model.eval()
+    # Preprocess the same way as the trainer so the model sees the pixels it was trained on
+    preprocessor = GPUImagePreprocessor(image_processor, device)
 
     LOGGER.info("Running inference on the dataset to classify %s", output_names)
 
     count = 0
 
     for sample in dataset:
-        image = sample["jpg"]
+        jpg = sample["jpg"]["bytes"]
+        image = Image.open(io.BytesIO(jpg))
         labels = [sample["json"][name] for name in output_names]
         image_name = sample["__key__"]
 
-        transformed_image = image_processor(image, return_tensors="pt")
-        transformed_image = transformed_image["pixel_values"]
-        transformed_image = transformed_image.to(device)
+        transformed_image = preprocessor([jpg])
 
         with torch.no_grad():
             _, outputs = model(transformed_image, torch.tensor([labels]).to(device))
@@ -106,6 +112,9 @@ def get_args_parser():
     parser.add_argument("--dataset", help="Path to the directory containing the dataset to load")
     parser.add_argument("--split", help="Which dataset split to load.", default="test")
     parser.add_argument("--model-dir", help="Path to the directory containing the trained model.")
+    parser.add_argument(
+        "--allow-pickle", action="store_true", help="Load a trusted pickled model.pt from an older training run"
+    )
     parser.add_argument("--log", type=str, help="Log level", default="INFO")
     parser.add_argument("--log-file", type=str, help="Log file", default=None)
     parser.add_argument("--num-samples", type=int, help="Number of samples to run inference on", default=None)
@@ -0,0 +1,33 @@
+"""Loading of model.pt checkpoints written by the training scripts"""
+
+import logging
+import pickle
+
+import torch
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_checkpoint(path: str, map_location="cpu", allow_pickle: bool = False):
+    """
+    Load a model.pt checkpoint as a dict holding the state dict
+
+    Checkpoints from older training runs hold the whole pickled nn.Module instead. Unpickling can run arbitrary code,
+    so these are only loaded with allow_pickle, the module is then returned as is with a deprecation warning.
+    """
+    try:
+        return torch.load(path, map_location=map_location, mmap=True, weights_only=True)
+    except pickle.UnpicklingError as e:
+        if not allow_pickle:
+            raise ValueError(
+                f"{path} is not a state dict checkpoint, it may be a pickled model from an older training run. "
+                "Only if the file is trusted, load it with allow_pickle (--allow-pickle)"
+            ) from e
+
+    model = torch.load(path, map_location=map_location, weights_only=False)
+    if not isinstance(model, torch.nn.Module):
+        raise ValueError(f"{path} is neither a state dict checkpoint nor a pickled model")
+    LOGGER.warning(
+        "%s holds a pickled model, this checkpoint format is deprecated. Retrain or re-save it as a state dict", path
+    )
+    return model
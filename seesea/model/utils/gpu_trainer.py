@@ -0,0 +1,32 @@
+"""Trainer that preprocesses the image batches on the training device"""
+
+from transformers import Trainer
+
+from seesea.model.utils.gpu_transforms import CachedImageDataset, GPUImagePreprocessor
+from seesea.model.utils.prefetch import CUDAPrefetcher
+
+
+class GPUPreprocessingTrainer(Trainer):
+    """Trainer that decodes and preprocesses the raw JPEG batches on the training device"""
+
+    def __init__(self, *args, preprocessor: GPUImagePreprocessor, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preprocessor = preprocessor
+
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        inputs = dict(inputs)
+        # Only augment the training batches, evaluation runs with the model in eval mode
+        pixel_values = self.preprocessor.prepare(inputs, augment=model.training)
+        inputs.pop("jpg", None)
+        inputs["pixel_values"] = pixel_values
+        return super().compute_loss(model, inputs, *args, **kwargs)
+
+    def get_train_dataloader(self):
+        dataloader = super().get_train_dataloader()
+        # JPEG batches are decoded from host bytes, prefetching only pays off for the cached pixel values
+        if self.args.device.type != "cuda" or not isinstance(self.train_dataset, CachedImageDataset):
+            return dataloader
+        # Leave the device copies to the prefetcher instead of the accelerate dataloader
+        if hasattr(dataloader, "device"):
+            dataloader.device = None
+        return CUDAPrefetcher(dataloader, self.args.device)
@@ -0,0 +1,305 @@
+"""Batched JPEG decoding and image preprocessing on the model device"""
+
+import json
+import math
+import os
+import shutil
+from typing import Callable, List, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchvision.io import decode_jpeg, ImageReadMode
+from torchvision.transforms import v2
+
+
+def get_resize_and_crop(image_processor):
+    """Get the resize and center crop sizes that match a HuggingFace image processor"""
+    size = image_processor.size
+    crop = None
+
+    if "height" in size and "width" in size:
+        resize = (size["height"], size["width"])
+    else:
+        shortest_edge = size["shortest_edge"]
+        crop_pct = getattr(image_processor, "crop_pct", None)
+        if crop_pct is not None:
+            # Mirror the ConvNext processor: resize past the target and crop back below 384, warp above
+            if shortest_edge < 384:
+                return int(shortest_edge / crop_pct), (shortest_edge, shortest_edge)
+            return (shortest_edge, shortest_edge), None
+        resize = shortest_edge
+
+    if getattr(image_processor, "do_center_crop", False):
+        crop = (image_processor.crop_size["height"], image_processor.crop_size["width"])
+
+    return resize, crop
+
+
+class RandomRotationBatch:
+    """Rotate each image in a float NCHW batch by its own random angle in [-degrees, degrees]"""
+
+    def __init__(self, degrees: float):
+        self.degrees = degrees
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        batch_size, _, height, width = images.shape
+        angles = torch.empty(batch_size, device=images.device).uniform_(-self.degrees, self.degrees)
+        angles = angles * (math.pi / 180)
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        zeros = torch.zeros_like(angles)
+
+        # Affine grids use normalized coordinates, scale by the aspect ratio to rotate in pixel space
+        theta = torch.stack(
+            [
+                torch.stack([cos, -sin * height / width, zeros], dim=1),
+                torch.stack([sin * width / height, cos, zeros], dim=1),
+            ],
+            dim=1,
+        )
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        return F.grid_sample(images, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+
+
+def random_rot90_batch(images: torch.Tensor) -> torch.Tensor:
+    """Rotate each image in a square NCHW batch by a random multiple of 90 degrees"""
+    if images.shape[-1] != images.shape[-2]:
+        raise ValueError("Random 90 degree rotations require square images")
+
+    k = torch.randint(0, 4, (images.shape[0],))
+    rotated = images.clone()
+    for turns in range(1, 4):
+        indices = torch.nonzero(k == turns).flatten().to(images.device)
+        if len(indices) > 0:
+            rotated[indices] = torch.rot90(images[indices], turns, dims=(-2, -1))
+    return rotated
+
+
+# HuggingFace processors store the resampling filter as a PIL filter id
+INTERPOLATION_MODES = {
+    0: v2.InterpolationMode.NEAREST,
+    2: v2.InterpolationMode.BILINEAR,
+    3: v2.InterpolationMode.BICUBIC,
+}
+
+# Processing flags reproduced by GPUImagePreprocessor, images are always decoded as RGB
+SUPPORTED_PROCESSOR_FLAGS = {
+    "do_resize",
+    "do_center_crop",
+    "do_rescale",
+    "do_normalize",
+    "do_flip_channel_order",
+    "do_convert_rgb",
+}
+
+
+class GPUImagePreprocessor:
+    """
+    Decode raw JPEG bytes and resize/normalize them as a batch on the model device
+
+    Replaces running the HuggingFace image processor on PIL images in the dataloader workers. Decoding uses
+    NVJPEG when the device is a CUDA device. On other devices the images are decoded with libjpeg-turbo and resized
+    on the CPU, in the dataloader workers when batches are collated with collate_jpeg. The optional augmentation is
+    applied to the whole batch after it has been resized and rescaled, before normalization.
+    With channels_last the pixel values are returned in NHWC memory layout to match a channels_last model.
+    Raises a ValueError for image processors using steps or resampling filters that cannot be reproduced.
+    """
+
+    def __init__(
+        self,
+        image_processor,
+        device: torch.device,
+        augmentation: Optional[Callable] = None,
+        channels_last: bool = False,
+    ):
+        self.device = device
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.decode_device = device if device.type == "cuda" else torch.device("cpu")
+        self.decode_on_host = self.decode_device.type == "cpu"
+        self.augmentation = augmentation
+
+        processor_name = type(image_processor).__name__
+        unsupported = [
+            key
+            for key, value in image_processor.to_dict().items()
+            if key.startswith("do_") and value and key not in SUPPORTED_PROCESSOR_FLAGS
+        ]
+        if unsupported:
+            raise ValueError(f"{processor_name} uses unsupported processing steps: {', '.join(unsupported)}")
+
+        self.resize = None
+        if getattr(image_processor, "do_resize", True):
+            resample = int(getattr(image_processor, "resample", 2))
+            if resample not in INTERPOLATION_MODES:
+                raise ValueError(f"{processor_name} uses an unsupported resampling filter: {resample}")
+            resize, crop = get_resize_and_crop(image_processor)
+            resize_transforms = [v2.Resize(resize, interpolation=INTERPOLATION_MODES[resample], antialias=True)]
+            if crop is not None:
+                resize_transforms.append(v2.CenterCrop(crop))
+            self.resize = v2.Compose(resize_transforms)
+
+        self.rescale_factor = image_processor.rescale_factor if getattr(image_processor, "do_rescale", False) else None
+        self.flip_channel_order = getattr(image_processor, "do_flip_channel_order", False)
+
+        self.normalize = None
+        if getattr(image_processor, "do_normalize", False):
+            self.normalize = v2.Normalize(mean=image_processor.image_mean, std=image_processor.image_std)
+
+    def decode_resize(self, jpegs: List[bytes]) -> torch.Tensor:
+        """Decode a list of JPEG encoded images into a resized uint8 NCHW tensor on the decode device"""
+        data = [torch.frombuffer(bytearray(jpeg), dtype=torch.uint8) for jpeg in jpegs]
+        images = decode_jpeg(data, mode=ImageReadMode.RGB, device=self.decode_device)
+        if self.resize is not None:
+            images = [self.resize(image) for image in images]
+        return torch.stack(images)
+
+    def decode(self, jpegs: List[bytes]) -> torch.Tensor:
+        """Decode a list of JPEG encoded images into a resized uint8 NCHW tensor on the device"""
+        return self.decode_resize(jpegs).to(self.device, non_blocking=True)
+
+    def transform(self, images: torch.Tensor, augment: bool = False) -> torch.Tensor:
+        """Rescale, augment and normalize a resized uint8 NCHW batch into model pixel values"""
+        images = images.float()
+        if self.rescale_factor is not None:
+            images = images * self.rescale_factor
+        if self.flip_channel_order:
+            # RGB to BGR, as done by the MobileViT processor
+            images = images.flip(-3)
+        if augment and self.augmentation is not None:
+            images = self.augmentation(images)
+        if self.normalize is not None:
+            images = self.normalize(images)
+        return images.contiguous(memory_format=self.memory_format)
+
+    def __call__(self, jpegs: List[bytes], augment: bool = False) -> torch.Tensor:
+        """Decode, resize and normalize a list of JPEG encoded images into model pixel values"""
+        return self.transform(self.decode(jpegs), augment)
+
+    def prepare(self, batch: dict, augment: bool = False) -> torch.Tensor:
+        """Get the model pixel values for a collate_jpeg batch holding either JPEG bytes or resized images"""
+        if "jpg" in batch:
+            images = self.decode(batch["jpg"])
+        else:
+            images = batch["pixel_values"].to(self.device, non_blocking=True)
+        return self.transform(images, augment)
+
+
+def preprocess_batch_jpeg(label_keys: list, samples):
+    """Preprocess a batch of samples, keeping the images as raw JPEG bytes to be decoded on the device"""
+    labels = np.empty((len(samples["json"]), len(label_keys)), dtype=np.float32)
+    for i, key in enumerate(label_keys):
+        labels[:, i] = [obj[key] for obj in samples["json"]]
+    return {"jpg": [jpg["bytes"] for jpg in samples["jpg"]], "labels": labels}
+
+
+def collate_jpeg(samples, preprocessor: Optional[GPUImagePreprocessor] = None):
+    """
+    Collate samples holding raw JPEG bytes, leaving the images to be decoded on the model device
+
+    Samples from a preprocessed cache already hold resized uint8 pixel values, these are stacked instead. When the
+    preprocessor decodes on the host the images are decoded and resized here, in the dataloader workers.
+    """
+    labels = [sample["labels"] for sample in samples]
+    if isinstance(labels[0], torch.Tensor):
+        batch = {"labels": torch.stack(labels)}
+    else:
+        # Stack the label rows in one call rather than converting them element by element
+        batch = {"labels": torch.from_numpy(np.asarray(labels))}
+    if "jpg" in samples[0] and preprocessor is not None and preprocessor.decode_on_host:
+        batch["pixel_values"] = preprocessor.decode_resize([sample["jpg"] for sample in samples])
+    elif "jpg" in samples[0]:
+        batch["jpg"] = [sample["jpg"] for sample in samples]
+    else:
+        batch["pixel_values"] = torch.stack([sample["pixel_values"] for sample in samples])
+    return batch
+
+
+def build_preprocessed_cache(loader, preprocessor: GPUImagePreprocessor, num_samples: int, path: str):
+    """
+    Decode and resize every image from a JPEG loader once and save them with their labels as uint8 arrays
+
+    The cache is a directory of .npy files that are written batch by batch through memory maps, so the split
+    never has to fit in host memory. The sample count is written last and marks the cache as complete.
+    """
+    # Build in a temporary directory so an interrupted build is not mistaken for a complete cache
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+
+    pixel_values = None
+    labels = None
+    count = 0
+    for batch in loader:
+        images = batch["pixel_values"] if "pixel_values" in batch else preprocessor.decode(batch["jpg"])
+        images = images.cpu().numpy()
+        batch_labels = np.asarray(batch["labels"])
+        if pixel_values is None:
+            pixel_values = np.lib.format.open_memmap(
+                os.path.join(temp_path, "pixel_values.npy"),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(num_samples, *images.shape[1:]),
+            )
+            labels = np.lib.format.open_memmap(
+                os.path.join(temp_path, "labels.npy"),
+                mode="w+",
+                dtype=batch_labels.dtype,
+                shape=(num_samples, *batch_labels.shape[1:]),
+            )
+        batch_size = min(len(images), num_samples - count)
+        pixel_values[count : count + batch_size] = images[:batch_size]
+        labels[count : count + batch_size] = batch_labels[:batch_size]
+        count += batch_size
+        if count == num_samples:
+            break
+
+    if pixel_values is None:
+        shutil.rmtree(temp_path)
+        raise ValueError("Cannot build a preprocessed cache from an empty dataset")
+
+    pixel_values.flush()
+    labels.flush()
+    del pixel_values, labels
+
+    # A short split only uses the first rows of the preallocated files
+    with open(os.path.join(temp_path, "cache.json"), "w", encoding="utf-8") as f:
+        json.dump({"num_samples": count}, f)
+    os.replace(temp_path, path)
+
+
+class CachedImageDataset(torch.utils.data.Dataset):
+    """
+    Resized uint8 images and labels memory mapped from a cache written by build_preprocessed_cache
+
+    The memory maps are opened on first access and dropped when pickled, so spawned dataloader workers open their
+    own maps instead of receiving a copy of the whole cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "cache.json"), "r", encoding="utf-8") as f:
+            self.num_samples = json.load(f)["num_samples"]
+        self.pixel_values = None
+        self.labels = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pixel_values"] = None
+        state["labels"] = None
+        return state
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        if index >= self.num_samples:
+            raise IndexError(index)
+        if self.pixel_values is None:
+            self.pixel_values = np.load(os.path.join(self.path, "pixel_values.npy"), mmap_mode="r")
+            self.labels = np.load(os.path.join(self.path, "labels.npy"), mmap_mode="r")
+        # Copy the rows out of the read only memory map
+        return {
+            "pixel_values": torch.from_numpy(np.array(self.pixel_values[index])),
+            "labels": torch.from_numpy(np.array(self.labels[index])),
+        }
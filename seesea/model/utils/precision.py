@@ -0,0 +1,44 @@
+"""Helpers for choosing the numeric precision to train and run the models in"""
+
+from typing import Optional
+
+import torch
+from torch import nn
+
+
+def get_mixed_precision_dtype(device: torch.device) -> Optional[torch.dtype]:
+    """Get the autocast dtype for a device, bf16 where supported, fp16 on older CUDA GPUs, None otherwise"""
+    if device.type != "cuda":
+        return None
+    # is_bf16_supported() also reports emulated bf16 on older GPUs, only use it where it runs natively (Ampere or newer)
+    return torch.bfloat16 if torch.cuda.get_device_capability(device)[0] >= 8 else torch.float16
+
+
+def supports_tf32(device: torch.device) -> bool:
+    """Check if a device supports TF32 matmuls (Ampere or newer)"""
+    return device.type == "cuda" and torch.cuda.get_device_capability(device)[0] >= 8
+
+
+def quantize_int8(model: nn.Module, device: torch.device) -> nn.Module:
+    """
+    Quantize the linear layer weights of a model to INT8 for inference on a device
+
+    On the CPU this uses PyTorch dynamic quantization, on CUDA torchao weight only quantization (requires torchao).
+    """
+    if device.type == "cpu":
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    if device.type == "cuda":
+        try:
+            from torchao.quantization import quantize_
+        except ImportError as e:
+            raise ImportError("INT8 quantization on CUDA requires torchao, install it with: pip install torchao") from e
+        try:
+            from torchao.quantization import Int8WeightOnlyConfig
+        except ImportError:
+            # Older torchao releases only have the deprecated function form of the config
+            from torchao.quantization import int8_weight_only as Int8WeightOnlyConfig
+        quantize_(model, Int8WeightOnlyConfig())
+        return model
+
+    raise ValueError(f"INT8 quantization is not supported on {device.type} devices")
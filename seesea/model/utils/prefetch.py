@@ -0,0 +1,50 @@
+"""Overlap host to device batch copies with compute"""
+
+import torch
+
+
+def _batch_to_device(batch: dict, device: torch.device) -> dict:
+    """Copy the tensors in a batch to a device, leaving any other values (eg raw JPEG bytes) on the host"""
+    return {k: v.to(device, non_blocking=True) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+
+
+class CUDAPrefetcher:
+    """
+    Wrap a dataloader to copy the next batch to the GPU on a side stream while the current batch is processed
+
+    The wrapped loader should use pinned memory so the copies are asynchronous. Any other attribute access is
+    forwarded to the wrapped loader.
+    """
+
+    def __init__(self, loader, device: torch.device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def _preload(self, iterator, stream: torch.cuda.Stream):
+        batch = next(iterator, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(stream):
+            return _batch_to_device(batch, self.device)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            for value in batch.values():
+                if isinstance(value, torch.Tensor):
+                    # The memory was allocated on the side stream but is used on the current one
+                    value.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self._preload(iterator, stream)
+            yield batch
@@ -17,9 +17,10 @@ def main(args):
     # Create output directory if it doesn't exist
     os.makedirs(args.output, exist_ok=True)
 
-    # Save model in pytorch format
+    # Save model in pytorch format, as a state dict with the config to rebuild the architecture
     output_path = os.path.join(args.output, "model.pt")
-    torch.save(model, output_path)
+    model.config.save_pretrained(args.output)
+    torch.save({"state_dict": model.state_dict(), "base_model_name": args.input}, output_path)
     LOGGER.info("Model saved to %s", output_path)
 
 
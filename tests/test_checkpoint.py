@@ -0,0 +1,41 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from torch import nn
+
+from seesea.model.utils.checkpoint import load_checkpoint
+
+
+class TestLoadCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "model.pt")
+        self.model = nn.Linear(4, 2)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_state_dict_checkpoint(self):
+        torch.save({"state_dict": self.model.state_dict(), "base_model_name": "test"}, self.path)
+        checkpoint = load_checkpoint(self.path)
+        self.assertEqual(checkpoint["base_model_name"], "test")
+        torch.testing.assert_close(checkpoint["state_dict"]["weight"], self.model.weight.detach())
+
+    def test_pickled_model_requires_opt_in(self):
+        torch.save(self.model, self.path)
+        with self.assertRaises(ValueError):
+            load_checkpoint(self.path)
+
+    def test_pickled_model_with_opt_in(self):
+        torch.save(self.model, self.path)
+        with self.assertLogs("seesea.model.utils.checkpoint", level="WARNING"):
+            model = load_checkpoint(self.path, allow_pickle=True)
+        self.assertIsInstance(model, nn.Linear)
+        torch.testing.assert_close(model.weight, self.model.weight)
+
+
+if __name__ == "__main__":
+    unittest.main()
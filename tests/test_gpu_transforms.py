@@ -0,0 +1,152 @@
+import io
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from PIL import Image
+
+from seesea.model.utils.gpu_transforms import (
+    CachedImageDataset,
+    GPUImagePreprocessor,
+    RandomRotationBatch,
+    build_preprocessed_cache,
+    collate_jpeg,
+    random_rot90_batch,
+)
+
+# Newer transformers releases default to torchvision backed processors, compare against the PIL implementations
+try:
+    from transformers import (
+        ConvNextImageProcessorPil as ConvNextImageProcessor,
+        MobileViTImageProcessorPil as MobileViTImageProcessor,
+        ViTImageProcessorPil as ViTImageProcessor,
+    )
+except ImportError:
+    from transformers import ConvNextImageProcessor, MobileViTImageProcessor, ViTImageProcessor
+
+
+def make_jpeg(width=320, height=240):
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255 / width, y * 255 / height, (x + y) * 255 / (width + height)], axis=-1)
+    buffer = io.BytesIO()
+    Image.fromarray(image.astype(np.uint8)).save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+class TestGPUImagePreprocessor(unittest.TestCase):
+
+    def setUp(self):
+        self.jpeg = make_jpeg()
+        self.device = torch.device("cpu")
+
+    def assert_matches_processor(self, image_processor):
+        expected = image_processor(Image.open(io.BytesIO(self.jpeg)), return_tensors="pt")["pixel_values"]
+        pixel_values = GPUImagePreprocessor(image_processor, self.device)([self.jpeg])
+        self.assertEqual(pixel_values.shape, expected.shape)
+        torch.testing.assert_close(pixel_values, expected, atol=0.05, rtol=0)
+
+    def test_matches_vit_processor(self):
+        self.assert_matches_processor(ViTImageProcessor(size={"height": 224, "width": 224}, resample=3))
+
+    def test_matches_convnext_processor(self):
+        self.assert_matches_processor(ConvNextImageProcessor(size={"shortest_edge": 224}, crop_pct=0.875))
+
+    def test_matches_mobilevit_processor(self):
+        self.assert_matches_processor(
+            MobileViTImageProcessor(size={"shortest_edge": 128}, crop_size={"height": 112, "width": 112})
+        )
+
+    def test_unsupported_resample(self):
+        with self.assertRaises(ValueError):
+            GPUImagePreprocessor(ViTImageProcessor(resample=1), self.device)
+
+    def test_collate_decodes_on_host(self):
+        preprocessor = GPUImagePreprocessor(ViTImageProcessor(size={"height": 64, "width": 64}), self.device)
+        samples = [{"jpg": self.jpeg, "labels": np.float32([1.0])}, {"jpg": self.jpeg, "labels": np.float32([2.0])}]
+        batch = collate_jpeg(samples, preprocessor=preprocessor)
+        self.assertNotIn("jpg", batch)
+        self.assertEqual(batch["pixel_values"].shape, (2, 3, 64, 64))
+        self.assertEqual(batch["pixel_values"].dtype, torch.uint8)
+        torch.testing.assert_close(preprocessor.prepare(batch), preprocessor([self.jpeg, self.jpeg]))
+
+
+class TestRotation(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.images = torch.rand(8, 3, 16, 16)
+
+    def test_rot90_matches_torch_rot90(self):
+        # This seed draws every multiple of 90 degrees for a batch of 8
+        torch.manual_seed(2)
+        rotated = random_rot90_batch(self.images)
+        torch.manual_seed(2)
+        turns = torch.randint(0, 4, (len(self.images),))
+        self.assertEqual(sorted(turns.unique().tolist()), [0, 1, 2, 3])
+        for image, result, k in zip(self.images, rotated, turns):
+            torch.testing.assert_close(result, torch.rot90(image, int(k), dims=(-2, -1)))
+
+    def test_rot90_rejects_non_square(self):
+        with self.assertRaises(ValueError):
+            random_rot90_batch(torch.rand(2, 3, 16, 12))
+
+    def test_zero_degree_rotation_is_identity(self):
+        images = torch.rand(4, 3, 12, 20)
+        torch.testing.assert_close(RandomRotationBatch(0)(images), images)
+
+
+class TestPreprocessedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "cache")
+        image_processor = ViTImageProcessor(size={"height": 32, "width": 32})
+        self.preprocessor = GPUImagePreprocessor(image_processor, torch.device("cpu"))
+        jpegs = [make_jpeg(40 + 8 * i, 32) for i in range(6)]
+        labels = np.arange(12, dtype=np.float32).reshape(6, 2)
+        self.batches = [{"jpg": jpegs[i : i + 3], "labels": torch.from_numpy(labels[i : i + 3])} for i in (0, 3)]
+        self.expected_pixel_values = self.preprocessor.decode(jpegs)
+        self.expected_labels = torch.from_numpy(labels)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_short_split_round_trip(self):
+        build_preprocessed_cache(self.batches, self.preprocessor, 10, self.path)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        self.assertTrue(os.path.exists(os.path.join(self.path, "cache.json")))
+
+        dataset = CachedImageDataset(self.path)
+        self.assertEqual(len(dataset), 6)
+        for i in range(6):
+            torch.testing.assert_close(dataset[i]["pixel_values"], self.expected_pixel_values[i])
+            torch.testing.assert_close(dataset[i]["labels"], self.expected_labels[i])
+        with self.assertRaises(IndexError):
+            dataset[6]
+
+    def test_stops_at_num_samples(self):
+        build_preprocessed_cache(self.batches, self.preprocessor, 4, self.path)
+        dataset = CachedImageDataset(self.path)
+        self.assertEqual(len(dataset), 4)
+        torch.testing.assert_close(dataset[3]["labels"], self.expected_labels[3])
+
+    def test_empty_loader_leaves_no_cache(self):
+        with self.assertRaises(ValueError):
+            build_preprocessed_cache([], self.preprocessor, 4, self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_pickle_does_not_copy_the_cache(self):
+        build_preprocessed_cache(self.batches, self.preprocessor, 6, self.path)
+        dataset = CachedImageDataset(self.path)
+        dataset[0]
+        restored = pickle.loads(pickle.dumps(dataset))
+        self.assertIsNone(restored.pixel_values)
+        torch.testing.assert_close(restored[5]["pixel_values"], self.expected_pixel_values[5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from torch import nn
+
+from seesea.model.multihead.multihead_model import MultiHeadModel, load_multihead_model
+
+
+class TestMultiHeadModel(unittest.TestCase):
+
+    class MockBackbone(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.conv = nn.Conv2d(3, 8, kernel_size=3, padding=1)
+
+        def forward(self, pixel_values):
+            return (self.conv(pixel_values),)
+
+    class MockClassifier(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.base_model = TestMultiHeadModel.MockBackbone()
+            self.fc = nn.Linear(8, 10)
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.num_outputs = 3
+        self.pixel_values = torch.randn(4, 3, 16, 16)
+
+    def test_load_separate_heads_state_dict(self):
+        old_model = MultiHeadModel(self.MockClassifier(), self.num_outputs)
+        state_dict = old_model.state_dict()
+        del state_dict["head.weight"], state_dict["head.bias"]
+        heads = [nn.Linear(8, 1) for _ in range(self.num_outputs)]
+        for i, head in enumerate(heads):
+            state_dict[f"heads.{i}.weight"] = head.weight.detach().clone()
+            state_dict[f"heads.{i}.bias"] = head.bias.detach().clone()
+
+        model = MultiHeadModel(self.MockClassifier(), self.num_outputs)
+        model.load_state_dict(state_dict)
+        model.eval()
+
+        with torch.no_grad():
+            _, logits = model(self.pixel_values)
+            features = old_model.base_model.base_model(self.pixel_values)[0].mean(dim=(2, 3))
+            expected = torch.cat([head(features) for head in heads], dim=1)
+
+        self.assertEqual(logits.shape, (4, self.num_outputs))
+        torch.testing.assert_close(logits, expected)
+
+    def test_load_pickled_separate_heads_model(self):
+        model = MultiHeadModel(self.MockClassifier(), self.num_outputs)
+        # Recreate a model pickled before the heads were fused
+        heads = nn.ModuleList([nn.Linear(8, 1) for _ in range(self.num_outputs)])
+        del model.head
+        model.heads = heads
+
+        with tempfile.TemporaryDirectory() as model_dir:
+            torch.save(model, os.path.join(model_dir, "model.pt"))
+            with self.assertRaises(ValueError):
+                load_multihead_model(model_dir)
+            loaded = load_multihead_model(model_dir, allow_pickle=True)
+        loaded.eval()
+
+        self.assertFalse(hasattr(loaded, "heads"))
+        with torch.no_grad():
+            _, logits = loaded(self.pixel_values)
+            features = loaded.base_model.base_model(self.pixel_values)[0].mean(dim=(2, 3))
+            expected = torch.cat([head(features) for head in heads], dim=1)
+        torch.testing.assert_close(logits, expected)
+
+    def test_forward_without_labels(self):
+        model = MultiHeadModel(self.MockClassifier(), self.num_outputs)
+        loss, logits = model(self.pixel_values)
+        self.assertIsNone(loss)
+        self.assertEqual(logits.shape, (4, self.num_outputs))
+
+        loss, _ = model(self.pixel_values, torch.zeros(4, self.num_outputs))
+        self.assertEqual(loss.dim(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import json
+import os
+import tempfile
+import unittest
+
+import torch
+import webdataset as wds
+
+from seesea.model.multihead.train import make_training_pipeline
+from seesea.model.utils.gpu_transforms import collate_jpeg
+
+
+class TestTrainingPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.temp_dir.name, "train"))
+        with wds.TarWriter(os.path.join(self.temp_dir.name, "train", "shard-000000.tar")) as writer:
+            for i in range(6):
+                observation = {"wind_speed_mps": float(i), "wave_height_m": 0.5 * i}
+                writer.write({"__key__": f"{i:04d}", "jpg": b"jpeg", "json": json.dumps(observation).encode("utf-8")})
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_fewer_shards_than_workers(self):
+        dataset = make_training_pipeline(self.temp_dir.name, ["wind_speed_mps", "wave_height_m"], 6, shuffle_buffer=4)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=2, num_workers=2, collate_fn=collate_jpeg)
+        for _ in range(2):
+            labels = torch.cat([batch["labels"] for batch in loader])
+            self.assertEqual(sorted(labels[:, 0].tolist()), [0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+            torch.testing.assert_close(labels[:, 1], labels[:, 0] * 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()